@@ -1,30 +1,60 @@
+import hashlib
 import io
-from typing import Dict, List
-
+import multiprocessing
+import re
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+import numpy as np
 import pandas as pd
+from pandas.api.extensions import take
+from pandas.api.types import union_categoricals
 import streamlit as st
+import xlsxwriter
 from lxml import etree
 
 ###############################################################################
 # 🔎  DETECÇÃO RÁPIDA DE EVENTO ################################################
 ###############################################################################
 
+# O elemento do evento aparece logo no início do arquivo: uma busca por regex
+# nos primeiros bytes evita parsear o XML inteiro só para classificá-lo.
+_PEEK_BYTES = 8192
+_EVT_TAG_RE = re.compile(rb"<(?:[\w.-]+:)?(evtTabRubrica|evtRemun|evt1200|evtDeslig)\b")
+_EVT_TAG_CODES = {
+    b"evtTabRubrica": "S-1010",
+    b"evtRemun": "S-1200",
+    b"evt1200": "S-1200",
+    b"evtDeslig": "S-2299",
+}
+
+# Fallback com lxml: iter("{*}tag") casa o nome em C, em qualquer namespace
+# (sem predicados local-name()); só a busca do primeiro @Id continua em XPath,
+# compilado uma vez no import.
+_XP_FIRST_ID = etree.XPath("string((.//*[@Id])[1]/@Id)")
+
+def _has_tag(root: etree._Element, *names: str) -> bool:
+    return next(root.iter(*(f"{{*}}{n}" for n in names)), None) is not None
+
 def detect_event_code(xml_bytes: bytes) -> str:
     """Retorna o código do evento (ex.: 'S-1200', 'S-1010')."""
+    m = _EVT_TAG_RE.search(xml_bytes, 0, _PEEK_BYTES)
+    if m:
+        return _EVT_TAG_CODES[m.group(1)]
     try:
         root = etree.fromstring(xml_bytes)
     except Exception:
         return "UNKNOWN"
-    if root.xpath(".//*[local-name()='evtTabRubrica']"):
+    if _has_tag(root, "evtTabRubrica"):
         return "S-1010"
-    if root.xpath(".//*[local-name()='evtRemun'] | .//*[local-name()='evt1200']"):
+    if _has_tag(root, "evtRemun", "evt1200"):
         return "S-1200"
-    id_nodes = root.xpath(".//*[@Id][1]")
-    if id_nodes:
-        raw_id = id_nodes[0].get("Id", "")
-        if "S-" in raw_id:
-            return raw_id.split("S-")[-1].rjust(4, "0").join(["S-", ""])
-    if root.xpath(".//*[local-name()='evtDeslig']"):
+    raw_id = _XP_FIRST_ID(root)
+    if "S-" in raw_id:
+        return raw_id.split("S-")[-1].rjust(4, "0").join(["S-", ""])
+    if _has_tag(root, "evtDeslig"):
         return "S-2299"
     return "UNKNOWN"
 
@@ -32,20 +62,250 @@ def detect_event_code(xml_bytes: bytes) -> str:
 # ⛓️  CORE PARSERS (mesmos do commit anterior) #################################
 ###############################################################################
 
+@lru_cache(maxsize=1024)
+def _localname(tag: str) -> str:
+    """
+    '{ns}codRubr' → 'codRubr'. Memoizado com limite: as tags vêm de uploads
+    não confiáveis, mas o conjunto usado pelo eSocial é pequeno.
+    """
+    return etree.QName(tag).localname
+
 class BaseParser:
+    # Tabelas geradas (nome → mapa de colunas); HDR_TABLE tem 1 linha por arquivo
+    TABLES: Dict[str, Dict[str, str]] = {}
+    HDR_TABLE = ""
+    # Colunas convertidas para número em finalize (tabela → colunas)
+    NUM_COLS: Dict[str, List[str]] = {}
+    # Códigos numéricos pequenos: reduzidos a int8/int16 (float32 se houver vazios)
+    CODE_COLS = frozenset({
+        "Tipo Rubrica", "Incidência INSS", "Incidência IRRF", "Incidência FGTS",
+        "Código Categoria",
+    })
+    # Colunas muito repetitivas (um valor por arquivo/trabalhador) → category
+    CAT_COLS = ("ID Evento", "CPF Trabalhador", "Matrícula", "Código Rubrica", "Origem Arquivo")
+    # Identificadores completados com zeros à esquerda em finalize (coluna → largura)
+    ZFILL_COLS = {"CPF Trabalhador": 11, "Matrícula": 8}
+
+    # Tags do elemento raiz do evento e dos campos de cabeçalho (localname → coluna)
+    EVT_TAGS: frozenset = frozenset()
+    HDR_TAGS: Dict[str, str] = {}
+    # Demais tags tratadas pela máquina de estados do parser
+    BODY_TAGS: frozenset = frozenset()
+
+    # Campos dos itens de rubrica (itensRemun / detVerbas)
+    ITEM_TAGS = {
+        "codRubr": "cod_rubr",
+        "ideTabRubr": "ide_tab_rubr",
+        "qtdRubr": "qtd_rubr",
+        "vrRubr": "vr_rubr",
+        "indApurIR": "ind_apur_ir",
+    }
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+    @classmethod
+    def new_sinks(cls) -> Dict[str, Dict[str, list]]:
+        """Buffers colunares vazios para todas as tabelas do evento."""
+        return {name: cls._new_cols(cols) for name, cols in cls.TABLES.items()}
+
+    @classmethod
+    def parse_into(cls, xml_bytes: bytes, file_name: str, sinks: Dict[str, Dict[str, list]]) -> None:
+        """
+        Acrescenta as linhas de um arquivo nos buffers compartilhados ``sinks``.
+        Se o arquivo falhar no meio, as linhas parciais são descartadas.
+        """
+        marks = {name: max(map(len, cols.values())) for name, cols in sinks.items()}
+        try:
+            header = cls._parse_into(xml_bytes, sinks)
+            consts = {**header, "origem_arquivo": file_name}
+            for name, cols in sinks.items():
+                if name == cls.HDR_TABLE:
+                    for col, values in cols.items():
+                        values.append(consts[col])
+                else:
+                    cls._fill_consts(cols, consts)
+        except Exception:
+            for name, cols in sinks.items():
+                for values in cols.values():
+                    del values[marks[name]:]
+            raise
+
+    @classmethod
+    def finalize(cls, sinks: Dict[str, Dict[str, list]]) -> Dict[str, pd.DataFrame]:
+        """Constrói um único DataFrame por tabela a partir dos buffers."""
+        frames = {name: cls._frame(sinks[name], cols) for name, cols in cls.TABLES.items()}
+        for name, num_cols in cls.NUM_COLS.items():
+            df = frames[name]
+            for col in num_cols:
+                if col in cls.CODE_COLS:
+                    vals = pd.to_numeric(df[col], errors="coerce", downcast="integer")
+                    if vals.dtype.kind == "f":  # NaN impede inteiro; float32 é exato p/ códigos
+                        vals = pd.to_numeric(vals, downcast="float")
+                    df[col] = vals
+                else:
+                    # valores monetários/quantidades ficam em float64 (precisão)
+                    df[col] = pd.to_numeric(df[col], errors="coerce")
+        for name, df in frames.items():
+            # zfill vetorizado, antes do category (valores distintos podem coincidir);
+            # tabela vazia tem coluna object sem valores, que o .str rejeita
+            for col, width in cls.ZFILL_COLS.items():
+                if col in df.columns and len(df):
+                    df[col] = df[col].str.zfill(width)
+            if name == cls.HDR_TABLE:
+                continue
+            for col in cls.CAT_COLS:
+                if col in df.columns:
+                    df[col] = df[col].astype("category")
+        # demais textos/números em arrays Arrow (category e inteiros já reduzidos
+        # ficam como estão; convert_integer=False mantém valores em ponto flutuante)
+        return {
+            name: df.convert_dtypes(dtype_backend="pyarrow", convert_integer=False)
+            for name, df in frames.items()
+        }
+
+    @classmethod
+    def parse(cls, xml_bytes: bytes, file_name: str) -> Dict[str, pd.DataFrame]:
+        sinks = cls.new_sinks()
+        cls.parse_into(xml_bytes, file_name, sinks)
+        return cls.finalize(sinks)
+
+    # ------------------------------------------------------------------
+    # Helpers
+    # ------------------------------------------------------------------
+    @classmethod
+    def _parse_into(cls, xml_bytes: bytes, sinks: Dict[str, Dict[str, list]]) -> Dict[str, str]:
+        """Preenche as colunas variáveis e retorna o cabeçalho do evento."""
+        raise NotImplementedError
+
+    @classmethod
+    def _iterparse(cls, xml_bytes: bytes):
+        """
+        Percorre o XML em streaming, sem materializar a árvore inteira. O filtro
+        de tags ('{*}tag', qualquer namespace) é aplicado pela libxml2: só as
+        tags usadas pela máquina de estados chegam ao Python.
+
+        Os uploads não são confiáveis: entidades externas, DTDs e rede ficam
+        desligados (sem XXE) e os limites de segurança da libxml2 são mantidos.
+        """
+        tags = [f"{{*}}{t}" for t in (*cls.EVT_TAGS, *cls.HDR_TAGS, *cls.BODY_TAGS)]
+        for event, el in etree.iterparse(
+            io.BytesIO(xml_bytes),
+            events=("start", "end"),
+            tag=tags,
+            resolve_entities=False,
+            no_network=True,
+            load_dtd=False,
+        ):
+            yield event, el, _localname(el.tag)
+
     @staticmethod
-    def _txt(node: etree._Element, xpath: str) -> str:
-        if node is None:
-            return ""
-        res = node.xpath(xpath)
-        if not res:
-            return ""
-        val = res[0] if isinstance(res, list) else res
-        if isinstance(val, str):
-            return val.strip()
-        if hasattr(val, "text") and val.text:
-            return val.text.strip()
-        return str(val).strip()
+    def _text(node: etree._Element) -> str:
+        return (node.text or "").strip()
+
+    @staticmethod
+    def _children(node: etree._Element) -> Dict[str, str]:
+        """Texto dos filhos diretos de ``node``, indexado pelo localname."""
+        return {_localname(c.tag): (c.text or "").strip() for c in node.iterchildren(etree.Element)}
+
+    @staticmethod
+    def _new_cols(columns: Dict[str, str]) -> Dict[str, list]:
+        """Buffers colunares (uma lista por coluna) na ordem do mapa de colunas."""
+        return {k: [] for k in columns}
+
+    @staticmethod
+    def _fill_consts(cols: Dict[str, list], consts: Dict[str, str]) -> None:
+        """Completa as colunas constantes do arquivo até o nº de linhas das demais."""
+        n = max(len(v) for v in cols.values())
+        for col in cols.keys() & consts.keys():
+            cols[col].extend([consts[col]] * (n - len(cols[col])))
+
+    @staticmethod
+    def _frame(cols: Dict[str, list], columns: Dict[str, str]) -> pd.DataFrame:
+        # dtype=object: tabela sem linhas também sai com colunas de texto (não float64)
+        return pd.DataFrame(cols, copy=False, dtype=object).rename(columns=columns)
+
+    @classmethod
+    def _stream_dmdev(
+        cls,
+        xml_bytes: bytes,
+        item_tag: str,
+        cols_dm: Dict[str, list],
+        cols_rb: Dict[str, list],
+        dm_id_attrs=(),
+    ):
+        """
+        Máquina de estados comum ao S-1200 e ao S-2299.
+
+        Lê somente o primeiro evento do arquivo; para cada <dmDev> considera
+        apenas o primeiro <ideEstabLot> (lotação, matrícula e itens de rubrica).
+        Acrescenta em ``cols_dm``/``cols_rb`` só os campos variáveis e retorna
+        o cabeçalho (None se o evento não for encontrado); as colunas vindas do
+        cabeçalho são constantes por arquivo e ficam para ``parse_into``.
+        """
+        header: Dict[str, str] = {}
+
+        evt = est = None
+        dm: Dict[str, str] = {}
+        itens: List[Dict[str, str]] = []
+        in_dm = est_seen = False
+
+        for event, el, tag in cls._iterparse(xml_bytes):
+            if evt is None:
+                if event == "start" and tag in cls.EVT_TAGS:
+                    evt = el
+                    header["id_evento"] = el.get("Id", "")
+                continue
+
+            if event == "start":
+                if tag == "dmDev":
+                    in_dm, est_seen, itens = True, False, []
+                    dm = {"id": next((el.get(a) for a in dm_id_attrs if el.get(a)), "")}
+                elif tag == "ideEstabLot" and in_dm and not est_seen:
+                    est, est_seen = el, True
+                continue
+
+            # ---- event == "end" ----------------------------------------
+            if el is evt:
+                break
+            if tag in cls.HDR_TAGS:
+                header.setdefault(cls.HDR_TAGS[tag], cls._text(el))
+            if not in_dm:
+                continue
+
+            if est is not None:
+                if tag == item_tag:
+                    itens.append(cls._children(el))
+                    el.clear(keep_tail=True)
+                elif tag == "matricula":
+                    dm.setdefault(tag, cls._text(el))
+                elif tag == "codLotacao" and el.getparent() is est:
+                    dm.setdefault(tag, cls._text(el))
+                elif el is est:
+                    est = None
+            elif tag == "dmDev":
+                # ideDmDev e codCateg são filhos diretos do dmDev: uma varredura só
+                dm_vals = cls._children(el)
+                id_dm = dm["id"] or dm_vals.get("ideDmDev", "")
+                matric = dm.get("matricula", "")
+                cols_dm["id_dmdev"].append(id_dm)
+                cols_dm["cod_categ"].append(dm_vals.get("codCateg", ""))
+                cols_dm["matricula"].append(matric)
+                cols_dm["cod_lotacao"].append(dm.get("codLotacao", ""))
+
+                n = len(itens)
+                cols_rb["id_dmdev"].extend([id_dm] * n)
+                cols_rb["matricula"].extend([matric] * n)
+                for src, col in cls.ITEM_TAGS.items():
+                    cols_rb[col].extend([vals.get(src, "") for vals in itens])
+                in_dm = False
+                el.clear(keep_tail=True)
+
+        if evt is None:
+            return None
+        for col in cls.HDR_TAGS.values():
+            header.setdefault(col, "")
+        return header
 
 class Parser1010(BaseParser):
     """Extrai dados do evento S‑1010 em DataFrames."""
@@ -78,65 +338,90 @@ class Parser1010(BaseParser):
         "origem_arquivo": "Origem Arquivo",
     }
 
-    # ------------------------------------------------------------------
-    # Public API
-    # ------------------------------------------------------------------
-    @classmethod
-    def parse(cls, xml_bytes: bytes, file_name: str) -> Dict[str, pd.DataFrame]:
-        root = etree.fromstring(xml_bytes)
-        evt_nodes = root.xpath(".//*[local-name()='evtTabRubrica']")
-        if not evt_nodes:
-            raise ValueError("XML sem <evtTabRubrica> (S-1010).")
-        evt = evt_nodes[0]
-
-        header = {
-            "id_evento": evt.get("Id", ""),
-            "tp_amb": cls._txt(evt, "string(.//*[local-name()='tpAmb'])"),
-            "proc_emi": cls._txt(evt, "string(.//*[local-name()='procEmi'])"),
-            "ver_proc": cls._txt(evt, "string(.//*[local-name()='verProc'])"),
-            "tp_insc": cls._txt(evt, "string(.//*[local-name()='tpInsc'])"),
-            "nr_insc": cls._txt(evt, "string(.//*[local-name()='nrInsc'])"),
-            "origem_arquivo": file_name,
-        }
-        df_evt = pd.DataFrame([header]).rename(columns=cls.COL_EVT)
-
-        rows_rub: List[dict] = []
-        for action in ("inclusao", "alteracao", "exclusao"):
-            for node in evt.xpath(f".//*[local-name()='{action}']"):
-                ide = node.xpath(".//*[local-name()='ideRubrica']")[0]
-                dados = node.xpath(".//*[local-name()='dadosRubrica']")
-                dados = dados[0] if dados else None
-
-                rows_rub.append(
-                    {
-                        "id_evento": header["id_evento"],
-                        "acao": action,
-                        "cod_rubr": cls._txt(ide, "string(.//*[local-name()='codRubr'])"),
-                        "ide_tab_rubr": cls._txt(ide, "string(.//*[local-name()='ideTabRubr'])"),
-                        "ini_valid": cls._txt(ide, "string(.//*[local-name()='iniValid'])"),
-                        "fim_valid": cls._txt(ide, "string(.//*[local-name()='fimValid'])"),
-                        "dsc_rubr": cls._txt(dados, "string(.//*[local-name()='dscRubr'])") if dados else "",
-                        "nat_rubr": cls._txt(dados, "string(.//*[local-name()='natRubr'])") if dados else "",
-                        "tp_rubr": cls._txt(dados, "string(.//*[local-name()='tpRubr'])") if dados else "",
-                        "cod_inc_cp": cls._txt(dados, "string(.//*[local-name()='codIncCP'])") if dados else "",
-                        "cod_inc_irrf": cls._txt(dados, "string(.//*[local-name()='codIncIRRF'])") if dados else "",
-                        "cod_inc_fgts": cls._txt(dados, "string(.//*[local-name()='codIncFGTS'])") if dados else "",
-                        "origem_arquivo": file_name,
-                    }
-                )
-
-        df_rub = pd.DataFrame(rows_rub).rename(columns=cls.COL_RUB)
-
-        # Conversões numéricas (exceto Natureza Rubrica)
-        num_cols = [
+    EVT_TAGS = frozenset({"evtTabRubrica"})
+    HDR_TAGS = {
+        "tpAmb": "tp_amb",
+        "procEmi": "proc_emi",
+        "verProc": "ver_proc",
+        "tpInsc": "tp_insc",
+        "nrInsc": "nr_insc",
+    }
+    ACTIONS = frozenset({"inclusao", "alteracao", "exclusao"})
+    BODY_TAGS = ACTIONS | {"ideRubrica", "dadosRubrica"}
+    IDE_TAGS = {
+        "codRubr": "cod_rubr",
+        "ideTabRubr": "ide_tab_rubr",
+        "iniValid": "ini_valid",
+        "fimValid": "fim_valid",
+    }
+    DADOS_TAGS = {
+        "dscRubr": "dsc_rubr",
+        "natRubr": "nat_rubr",
+        "tpRubr": "tp_rubr",
+        "codIncCP": "cod_inc_cp",
+        "codIncIRRF": "cod_inc_irrf",
+        "codIncFGTS": "cod_inc_fgts",
+    }
+
+    TABLES = {"CABECALHO_1010": COL_EVT, "RUBRICAS_1010": COL_RUB}
+    HDR_TABLE = "CABECALHO_1010"
+    # Conversões numéricas (exceto Natureza Rubrica)
+    NUM_COLS = {
+        "RUBRICAS_1010": [
             "Tipo Rubrica",
             "Incidência INSS",
             "Incidência IRRF",
             "Incidência FGTS",
-        ]
-        df_rub[num_cols] = df_rub[num_cols].apply(pd.to_numeric, errors="coerce")
+        ],
+    }
 
-        return {"CABECALHO_1010": df_evt, "RUBRICAS_1010": df_rub}
+    @classmethod
+    def _parse_into(cls, xml_bytes: bytes, sinks: Dict[str, Dict[str, list]]) -> Dict[str, str]:
+        header: Dict[str, str] = {}
+        cols_rub = sinks["RUBRICAS_1010"]
+
+        evt = None
+        action = None
+        ide: Dict[str, str] = {}
+        dados: Dict[str, str] = {}
+
+        for event, el, tag in cls._iterparse(xml_bytes):
+            if evt is None:
+                if event == "start" and tag in cls.EVT_TAGS:
+                    evt = el
+                    header["id_evento"] = el.get("Id", "")
+                continue
+
+            if event == "start":
+                if tag in cls.ACTIONS and action is None:
+                    action, ide, dados = tag, {}, {}
+                continue
+
+            if el is evt:
+                break
+            if tag in cls.HDR_TAGS:
+                header.setdefault(cls.HDR_TAGS[tag], cls._text(el))
+            if action is None:
+                continue
+
+            if tag == "ideRubrica" and not ide:
+                ide = cls._children(el)
+            elif tag == "dadosRubrica" and not dados:
+                dados = cls._children(el)
+            elif tag == action:
+                cols_rub["acao"].append(action)
+                for src, col in cls.IDE_TAGS.items():
+                    cols_rub[col].append(ide.get(src, ""))
+                for src, col in cls.DADOS_TAGS.items():
+                    cols_rub[col].append(dados.get(src, ""))
+                action = None
+                el.clear(keep_tail=True)
+
+        if evt is None:
+            raise ValueError("XML sem <evtTabRubrica> (S-1010).")
+        for col in cls.HDR_TAGS.values():
+            header.setdefault(col, "")
+        return header
 
 class Parser1200(BaseParser):
     """Extrai dados do evento S‑1200 em DataFrames."""
@@ -172,71 +457,35 @@ class Parser1200(BaseParser):
         "origem_arquivo": "Origem Arquivo",
     }
 
+    TABLES = {
+        "CABECALHO_1200": COL_EVT,
+        "DEMONSTRATIVO_1200": COL_DMDEV,
+        "RUBRICAS_1200": COL_RUB,
+    }
+    HDR_TABLE = "CABECALHO_1200"
+    # Conversões numéricas
+    NUM_COLS = {
+        "DEMONSTRATIVO_1200": ["Código Categoria"],
+        "RUBRICAS_1200": ["Quantidade", "Valor Rubrica (R$)"],
+    }
+
+    EVT_TAGS = frozenset({"evtRemun", "evt1200"})
+    BODY_TAGS = frozenset({"dmDev", "ideEstabLot", "codLotacao", "matricula", "itensRemun"})
+    HDR_TAGS = {
+        "perApur": "per_apur",
+        "indRetif": "ind_retif",
+        "tpAmb": "tp_amb",
+        "cpfTrab": "cpf_trab",
+    }
+
     @classmethod
-    def parse(cls, xml_bytes: bytes, file_name: str) -> Dict[str, pd.DataFrame]:
-        root = etree.fromstring(xml_bytes)
-        evt_nodes = root.xpath(
-            ".//*[local-name()='evtRemun'] | .//*[local-name()='evt1200']"
+    def _parse_into(cls, xml_bytes: bytes, sinks: Dict[str, Dict[str, list]]) -> Dict[str, str]:
+        header = cls._stream_dmdev(
+            xml_bytes, "itensRemun", sinks["DEMONSTRATIVO_1200"], sinks["RUBRICAS_1200"]
         )
-        if not evt_nodes:
+        if header is None:
             raise ValueError("XML sem <evtRemun>/<evt1200> (S-1200).")
-        evt = evt_nodes[0]
-
-        header = {
-            "id_evento": evt.get("Id", ""),
-            "per_apur": cls._txt(evt, "string(.//*[local-name()='perApur'])"),
-            "ind_retif": cls._txt(evt, "string(.//*[local-name()='indRetif'])"),
-            "tp_amb": cls._txt(evt, "string(.//*[local-name()='tpAmb'])"),
-            "cpf_trab": cls._txt(evt, "string(.//*[local-name()='cpfTrab'])").zfill(11),
-            "origem_arquivo": file_name,
-        }
-        df_evt = pd.DataFrame([header]).rename(columns=cls.COL_EVT)
-
-        rows_dm, rows_rb = [], []
-        for dm in evt.xpath(".//*[local-name()='dmDev']"):
-            id_dm = cls._txt(dm, "string(.//*[local-name()='ideDmDev'])")
-            cod_cat = cls._txt(dm, "string(.//*[local-name()='codCateg'])")
-            est = dm.xpath(".//*[local-name()='ideEstabLot']")[0]
-            cod_lot = cls._txt(est, "string(./*[local-name()='codLotacao'])")
-            matric = cls._txt(est, "string(.//*[local-name()='matricula'])").zfill(8)
-
-            rows_dm.append({
-                "id_dmdev": id_dm,
-                "id_evento": header["id_evento"],
-                "per_apur": header["per_apur"],
-                "cpf_trab": header["cpf_trab"],
-                "cod_categ": cod_cat,
-                "matricula": matric,
-                "cod_lotacao": cod_lot,
-                "origem_arquivo": file_name,
-            })
-
-            for it in est.xpath(".//*[local-name()='itensRemun']"):
-                rows_rb.append({
-                    "id_dmdev": id_dm,
-                    "per_apur": header["per_apur"],
-                    "cpf_trab": header["cpf_trab"],
-                    "matricula": matric,
-                    "cod_rubr": cls._txt(it, "string(.//*[local-name()='codRubr'])"),
-                    "ide_tab_rubr": cls._txt(it, "string(.//*[local-name()='ideTabRubr'])"),
-                    "qtd_rubr": cls._txt(it, "string(.//*[local-name()='qtdRubr'])"),
-                    "vr_rubr": cls._txt(it, "string(.//*[local-name()='vrRubr'])"),
-                    "ind_apur_ir": cls._txt(it, "string(.//*[local-name()='indApurIR'])"),
-                    "origem_arquivo": file_name,
-                })
-
-        df_dm = pd.DataFrame(rows_dm).rename(columns=cls.COL_DMDEV)
-        df_rb = pd.DataFrame(rows_rb).rename(columns=cls.COL_RUB)
-
-        # Conversões numéricas
-        df_dm["Código Categoria"] = pd.to_numeric(df_dm["Código Categoria"], errors="coerce")
-        df_rb[["Quantidade", "Valor Rubrica (R$)"]] = df_rb[["Quantidade", "Valor Rubrica (R$)"]].apply(pd.to_numeric, errors="coerce")
-
-        return {
-            "CABECALHO_1200": df_evt,
-            "DEMONSTRATIVO_1200": df_dm,
-            "RUBRICAS_1200": df_rb,
-        }
+        return header
 
 class Parser2299(BaseParser):
     """Extrai dados do evento S-2299 em DataFrames."""
@@ -272,79 +521,40 @@ class Parser2299(BaseParser):
         "origem_arquivo": "Origem Arquivo",
     }
 
-    @classmethod
-    def parse(cls, xml_bytes: bytes, file_name: str):
-        root = etree.fromstring(xml_bytes)
-        evt_nodes = root.xpath(".//*[local-name()='evtDeslig']")
-        if not evt_nodes:
-            raise ValueError("XML sem <evtDeslig> (S-2299).")
-        evt = evt_nodes[0]
-
-        header = {
-            "id_evento": evt.get("Id", ""),
-            "dt_deslig": cls._txt(evt, "string(.//*[local-name()='dtDeslig'])"),
-            "mtv_deslig": cls._txt(evt, "string(.//*[local-name()='mtvDeslig'])"),
-            "ind_retif": cls._txt(evt, "string(.//*[local-name()='indRetif'])"),
-            "tp_amb": cls._txt(evt, "string(.//*[local-name()='tpAmb'])"),
-            "cpf_trab": cls._txt(evt, "string(.//*[local-name()='cpfTrab'])").zfill(11),
-            "origem_arquivo": file_name,
-        }
-        df_evt = pd.DataFrame([header]).rename(columns=cls.COL_EVT)
-
-        rows_dm, rows_rb = [], []
-        for dm in evt.xpath(".//*[local-name()='dmDev']"):
-            id_dm = (
-                dm.get("id")
-                or dm.get("Id")
-                or cls._txt(dm, "string(.//*[local-name()='ideDmDev'])")
-            )
-            cod_cat = cls._txt(dm, "string(.//*[local-name()='codCateg'])")
-            est = dm.xpath(".//*[local-name()='ideEstabLot']")[0]
-            cod_lot = cls._txt(est, "string(./*[local-name()='codLotacao'])")
-            matric = cls._txt(est, "string(.//*[local-name()='matricula'])").zfill(8)
-
-            rows_dm.append(
-                {
-                    "id_dmdev": id_dm,
-                    "id_evento": header["id_evento"],
-                    "cpf_trab": header["cpf_trab"],
-                    "cod_categ": cod_cat,
-                    "matricula": matric,
-                    "cod_lotacao": cod_lot,
-                    "origem_arquivo": file_name,
-                }
-            )
+    TABLES = {
+        "CABECALHO_2299": COL_EVT,
+        "DEMONSTRATIVO_2299": COL_DMDEV,
+        "RUBRICAS_2299": COL_RUB,
+    }
+    HDR_TABLE = "CABECALHO_2299"
+    # Conversões numéricas
+    NUM_COLS = {
+        "DEMONSTRATIVO_2299": ["Código Categoria"],
+        "RUBRICAS_2299": ["Quantidade", "Valor Rubrica (R$)"],
+    }
 
-            for det in est.xpath(".//*[local-name()='detVerbas']"):
-                rows_rb.append(
-                    {
-                        "id_dmdev": id_dm,
-                        "dt_deslig": header["dt_deslig"],
-                        "cpf_trab": header["cpf_trab"],
-                        "matricula": matric,
-                        "cod_rubr": cls._txt(det, "string(.//*[local-name()='codRubr'])"),
-                        "ide_tab_rubr": cls._txt(det, "string(.//*[local-name()='ideTabRubr'])"),
-                        "qtd_rubr": cls._txt(det, "string(.//*[local-name()='qtdRubr'])"),
-                        "vr_rubr": cls._txt(det, "string(.//*[local-name()='vrRubr'])"),
-                        "ind_apur_ir": cls._txt(det, "string(.//*[local-name()='indApurIR'])"),
-                        "origem_arquivo": file_name,
-                    }
-                )
-
-        df_dm = pd.DataFrame(rows_dm).rename(columns=cls.COL_DMDEV)
-        df_rb = pd.DataFrame(rows_rb).rename(columns=cls.COL_RUB)
-
-        # Conversões numéricas
-        df_dm["Código Categoria"] = pd.to_numeric(df_dm["Código Categoria"], errors="coerce")
-        df_rb[["Quantidade", "Valor Rubrica (R$)"]] = df_rb[
-            ["Quantidade", "Valor Rubrica (R$)"]
-        ].apply(pd.to_numeric, errors="coerce")
+    EVT_TAGS = frozenset({"evtDeslig"})
+    BODY_TAGS = frozenset({"dmDev", "ideEstabLot", "codLotacao", "matricula", "detVerbas"})
+    HDR_TAGS = {
+        "dtDeslig": "dt_deslig",
+        "mtvDeslig": "mtv_deslig",
+        "indRetif": "ind_retif",
+        "tpAmb": "tp_amb",
+        "cpfTrab": "cpf_trab",
+    }
 
-        return {
-            "CABECALHO_2299": df_evt,
-            "DEMONSTRATIVO_2299": df_dm,
-            "RUBRICAS_2299": df_rb,
-        }
+    @classmethod
+    def _parse_into(cls, xml_bytes: bytes, sinks: Dict[str, Dict[str, list]]) -> Dict[str, str]:
+        header = cls._stream_dmdev(
+            xml_bytes,
+            "detVerbas",
+            sinks["DEMONSTRATIVO_2299"],
+            sinks["RUBRICAS_2299"],
+            dm_id_attrs=("id", "Id"),
+        )
+        if header is None:
+            raise ValueError("XML sem <evtDeslig> (S-2299).")
+        return header
 
 ###############################################################################
 # 🔗 FUNÇÃO DE JOIN COM CONVERSÃO DE DATAS ####################################
@@ -355,12 +565,14 @@ def harmonizar_rubricas_2299(df_rb_2299: pd.DataFrame) -> pd.DataFrame:
     Converte 'Data Desligamento' (dt_deslig) → 'Período Apuração'
     no formato YYYY-MM, alinha ordem de colunas para poder dar concat.
     """
-    df = df_rb_2299.copy()
-
-    # cria coluna 'Período Apuração' (yyyy-mm) a partir de dt_deslig
-    df["Período Apuração"] = pd.to_datetime(
-        df["Data Desligamento"], errors="coerce"
-    ).dt.strftime("%Y-%m")
+    # cria coluna 'Período Apuração' (yyyy-mm) a partir de dt_deslig;
+    # datetime64[M] → str formata em C, sem strftime elemento a elemento
+    d = pd.to_datetime(
+        df_rb_2299["Data Desligamento"], errors="coerce"
+    ).to_numpy("datetime64[ns]")
+    df = df_rb_2299.assign(**{
+        "Período Apuração": np.where(np.isnat(d), None, d.astype("datetime64[M]").astype("U7"))
+    })
 
     # garante que a nova coluna fique na mesma posição da do S-1200
     col_order_target = [
@@ -377,43 +589,248 @@ def harmonizar_rubricas_2299(df_rb_2299: pd.DataFrame) -> pd.DataFrame:
         # colunas exclusivas do S-2299 que queremos preservar
         "Data Desligamento",
     ]
-    # adiciona colunas faltantes como vazias
-    for c in col_order_target:
-        if c not in df.columns:
-            df[c] = pd.NA
-    df = df[col_order_target]  # reordena
-
-    return df
+    # reordena, criando vazias as colunas faltantes; tudo Arrow, como no S-1200,
+    # para o concat não cair em object
+    return df.reindex(columns=col_order_target).convert_dtypes(
+        dtype_backend="pyarrow", convert_integer=False
+    )
 
 def join_rubricas(df_rb: pd.DataFrame, df_rub: pd.DataFrame) -> pd.DataFrame:
     """
     Enriquece RUBRICAS_1200 (df_rb) com campos do RUBRICAS_1010 (df_rub)
     utilizando somente o 'Código Rubrica' como chave.
-    """
-    # cópias defensivas
-    df_rb  = df_rb.copy()
-    df_rub = df_rub.copy()
-
-    # merge simples
-    merged = df_rb.merge(
-        df_rub,
-        how="left",
-        on="Código Rubrica",
-        suffixes=("", "_1010"),
-    )
 
-    # seleciona colunas extras vindas do 1010
+    As colunas são acrescentadas em ``df_rb`` (sem cópia, mantendo o dtype
+    Arrow do S-1010), que é retornado.
+    Rubricas repetidas no S-1010 valem pela primeira ocorrência.
+    """
+    # colunas extras vindas do 1010
     extra_cols = [
         "Início Vigência", "Fim Vigência", "Descrição Rubrica", "Natureza Rubrica",
         "Tipo Rubrica", "Incidência INSS", "Incidência IRRF", "Incidência FGTS",
-        "Origem Arquivo_1010",
+        "Origem Arquivo",
     ]
 
-    # concatena lado a lado
-    return pd.concat(
-        [df_rb.reset_index(drop=True), merged[extra_cols].reset_index(drop=True)],
-        axis=1
+    # tabela de lookup indexada pelo código – um único hash da chave para
+    # todas as colunas, sem o frame intermediário do merge
+    lookup = (
+        df_rub.drop_duplicates("Código Rubrica")
+        .set_index("Código Rubrica")[extra_cols]
+        .rename(columns={"Origem Arquivo": "Origem Arquivo_1010"})
     )
+    key = df_rb["Código Rubrica"]
+    if isinstance(key.dtype, pd.CategoricalDtype):
+        # só as categorias passam pelo lookup; as linhas são expandidas pelos códigos
+        enriched = lookup.reindex(key.cat.categories)
+        codes = key.cat.codes.to_numpy()
+        for col in enriched.columns:
+            df_rb[col] = take(enriched[col].array, codes, allow_fill=True)
+    else:
+        enriched = lookup.reindex(key.to_numpy())
+        for col in enriched.columns:
+            df_rb[col] = enriched[col].array
+
+    return df_rb
+
+def empilhar_rubricas(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Empilha rubricas de eventos diferentes (S-1200 + S-2299 harmonizado).
+    As colunas categóricas recebem antes a união das categorias – com
+    categorias diferentes o concat as converteria para object.
+    Os frames recebidos não são alterados.
+    """
+    frames = [f.copy(deep=False) for f in frames]
+    for col in frames[0].columns:
+        if all(col in f.columns and isinstance(f[col].dtype, pd.CategoricalDtype) for f in frames):
+            cats = union_categoricals([f[col] for f in frames]).categories
+            for f in frames:
+                f[col] = f[col].cat.set_categories(cats)
+    return pd.concat(frames, ignore_index=True)
+
+###############################################################################
+# 📊 EXPORTAÇÃO EXCEL (xlsxwriter em modo constant_memory) ####################
+###############################################################################
+
+# Linhas convertidas para objetos Python por vez ao escrever uma planilha
+_XLSX_CHUNK = 10_000
+_XLSX_MAX_ROWS = 1_048_576  # limite de linhas de uma planilha do Excel
+
+def _write_sheet(wb: xlsxwriter.Workbook, sheet_name: str, df: pd.DataFrame) -> None:
+    """
+    Escreve ``df`` linha a linha – no modo constant_memory cada linha é
+    descarregada em disco ao passar para a próxima, então a escrita precisa
+    seguir a ordem das linhas (o to_excel do pandas escreve por coluna).
+
+    Levanta ValueError se a tabela não couber na planilha: o xlsxwriter
+    descartaria as linhas excedentes sem erro.
+    """
+    if len(df) + 1 > _XLSX_MAX_ROWS:  # + cabeçalho
+        raise ValueError(
+            f"A tabela {sheet_name} tem {len(df):,} linhas e excede o limite do Excel "
+            f"({_XLSX_MAX_ROWS - 1:,} linhas de dados por planilha)."
+        )
+    ws = wb.add_worksheet(sheet_name[:31])
+    hdr_fmt = wb.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    ws.write_row(0, 0, df.columns.tolist(), hdr_fmt)
+
+    r = 1
+    for start in range(0, len(df), _XLSX_CHUNK):
+        chunk = df.iloc[start:start + _XLSX_CHUNK]
+        chunk = chunk.astype(object).where(chunk.notna(), None)  # nulos → célula vazia
+        for row in chunk.itertuples(index=False, name=None):
+            if ws.write_row(r, 0, row) == -1:  # fora dos limites da planilha
+                raise ValueError(f"Não foi possível gravar a linha {r + 1:,} da planilha {sheet_name}.")
+            r += 1
+
+@st.cache_data(show_spinner="Gerando o Excel consolidado…", max_entries=4)
+def gerar_excel(chave: tuple, _sheets: List[Tuple[str, pd.DataFrame]]) -> bytes:
+    """
+    Gera o .xlsx com as planilhas ``_sheets`` (nome, DataFrame), na ordem dada.
+    ``chave`` identifica o conteúdo – os hashes dos uploads de cada passo –,
+    então o arquivo só é gerado de novo quando os uploads mudam.
+    """
+    buf = io.BytesIO()
+    with xlsxwriter.Workbook(
+        buf,
+        {"constant_memory": True, "strings_to_formulas": False, "strings_to_urls": False},
+    ) as wb:
+        for name, df in _sheets:
+            _write_sheet(wb, name, df)
+    return buf.getvalue()
+
+###############################################################################
+# ⚙️  CARGA DOS UPLOADS (parsing paralelo) ####################################
+###############################################################################
+
+@st.cache_resource
+def _executor() -> ProcessPoolExecutor:
+    """
+    Pool de processos reaproveitado entre os reruns do Streamlit. Usa "spawn":
+    um fork feito de dentro do servidor (multi-thread) pode herdar locks presos.
+    """
+    return ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"))
+
+def _parse_file(parser: type, xml_bytes: bytes, file_name: str) -> Dict[str, Dict[str, list]]:
+    """Parseia um arquivo em buffers próprios – roda nos processos do pool."""
+    sinks = parser.new_sinks()
+    try:
+        parser.parse_into(xml_bytes, file_name, sinks)
+    except etree.XMLSyntaxError as e:
+        # o error_log do lxml não é picklable: devolve só a mensagem ao processo principal
+        raise ValueError(f"XML inválido: {e}") from None
+    return sinks
+
+def _digest(f) -> str:
+    """Hash do conteúdo do upload, lido pelo buffer interno (sem cópia)."""
+    with f.getbuffer() as buf:
+        return hashlib.blake2b(buf, digest_size=16).hexdigest()
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _carregar_lote(
+    event_code: str,
+    keys: Tuple[Tuple[str, str], ...],
+    _files: list,
+    _parser: type,
+) -> Tuple[Dict[str, pd.DataFrame], List[Tuple[str, str]]]:
+    """
+    Detecta, parseia e consolida um lote de arquivos. O cache é indexado por
+    ``keys`` – (hash do conteúdo, nome) de cada arquivo –, então reruns com os
+    mesmos uploads não reprocessam nada. Avisos e erros voltam como dados
+    (nível, mensagem) para serem reexibidos a cada rerun.
+    """
+    avisos: List[Tuple[str, str]] = []
+    jobs = []
+    for (_, name), f in zip(keys, _files):
+        data = f.getvalue()  # cópia única, só quando o lote não está no cache
+        code = detect_event_code(data)
+        if code != event_code:
+            avisos.append(("warning", f"{name}: evento {code} não suportado neste passo; arquivo ignorado."))
+            continue
+        jobs.append((data, name))
+    if not jobs:
+        return {}, avisos
+
+    # O loop Python de montagem das linhas segura a GIL: processos > threads
+    futures = [None] * len(jobs)
+    if len(jobs) > 1:
+        ex = _executor()
+        for i, (data, name) in enumerate(jobs):
+            try:
+                futures[i] = ex.submit(_parse_file, _parser, data, name)
+            except BrokenProcessPool:
+                _executor.clear()  # o próximo lote recria o pool; o restante roda em série
+                break
+
+    sinks = _parser.new_sinks()
+    n_ok = 0
+    for (data, name), fut in zip(jobs, futures):
+        try:
+            try:
+                part = _parse_file(_parser, data, name) if fut is None else fut.result()
+            except BrokenProcessPool:
+                # um processo do pool morreu (ex.: falta de memória): descarta o
+                # pool e refaz o arquivo em série
+                _executor.clear()
+                part = _parse_file(_parser, data, name)
+        except Exception as e:
+            avisos.append(("error", f"Erro ao processar {name}: {e}"))
+            continue
+        for table, cols in part.items():
+            for col, values in cols.items():
+                sinks[table][col].extend(values)
+        n_ok += 1
+
+    if not n_ok:
+        return {}, avisos
+    try:
+        return _parser.finalize(sinks), avisos
+    except Exception as e:
+        avisos.append(("error", f"Erro ao consolidar os arquivos {event_code}: {e}"))
+        return {}, avisos
+
+def carregar_xmls(files, event_code: str, parser: type) -> Tuple[Dict[str, pd.DataFrame], tuple]:
+    """
+    Filtra os uploads pelo código do evento, parseia cada arquivo (em paralelo
+    quando há mais de um) e consolida tudo num único DataFrame por tabela.
+    Retorna também as chaves (hash, nome) dos arquivos, que identificam o lote.
+
+    O resultado fica em ``st.session_state`` por passo: enquanto os uploads
+    (file_id) forem os mesmos, os reruns provocados pelos outros passos não
+    releem nem recalculam o hash dos arquivos.
+    """
+    ids = tuple(sorted(f.file_id for f in files))
+    slot = f"parsed_{event_code}"
+    salvo = st.session_state.get(slot)
+    if salvo is None or salvo[0] != ids:
+        keys = tuple((_digest(f), f.name) for f in files)
+        frames, avisos = _carregar_lote(event_code, keys, files, parser)
+        salvo = st.session_state[slot] = (ids, frames, keys, avisos)
+
+    _, frames, keys, avisos = salvo
+    for level, msg in avisos:
+        getattr(st, level)(msg)
+    return dict(frames), keys  # cópia rasa: a UI acrescenta tabelas ao dict
+
+def descartar_xmls(event_code: str) -> None:
+    """Libera o resultado guardado por ``carregar_xmls`` quando o passo fica sem uploads."""
+    st.session_state.pop(f"parsed_{event_code}", None)
+
+_PREVIEW_ROWS = 1_000
+
+def mostrar_tabela(name: str, df: pd.DataFrame) -> None:
+    """
+    Exibe só as primeiras linhas da tabela; a tabela inteira vai para o
+    navegador apenas se o usuário marcar a opção (serializar tudo a cada
+    rerun é o que pesa com arquivos grandes).
+    """
+    if len(df) <= _PREVIEW_ROWS:
+        st.dataframe(df, use_container_width=True)
+        return
+    if st.checkbox("Exibir todas as linhas", key=f"completo_{name}"):
+        st.dataframe(df, use_container_width=True)
+    else:
+        st.caption(f"{len(df):,} linhas (exibindo {_PREVIEW_ROWS:,})")
+        st.dataframe(df.head(_PREVIEW_ROWS), use_container_width=True)
 
 ###############################################################################
 # 🖥️  STREAMLIT UI (idem, com join chamado) ##################################
@@ -444,25 +861,16 @@ files_1010 = st.file_uploader(
     "Selecione os arquivos XML do S-1010", type=["xml"], accept_multiple_files=True, key="s1010"
 )
 
-parsed_1010: Dict[str, List[pd.DataFrame]] = {}
+parsed_1010: Dict[str, pd.DataFrame] = {}
+keys_1010: tuple = ()
 if files_1010:
-    tmp: Dict[str, List[pd.DataFrame]] = {"CABECALHO_1010": [], "RUBRICAS_1010": []}
-    for f in files_1010:
-        event_code = detect_event_code(f.getvalue())
-        if event_code != "S-1010":
-            st.warning(f"{f.name}: evento {event_code} não suportado neste passo; arquivo ignorado.")
-            continue
-        try:
-            res = Parser1010.parse(f.getvalue(), f.name)
-            for k in tmp:
-                tmp[k].append(res[k])
-        except Exception as e:
-            st.error(f"Erro ao processar {f.name}: {e}")
-    parsed_1010 = {k: pd.concat(v, ignore_index=True) for k, v in tmp.items() if v}
+    parsed_1010, keys_1010 = carregar_xmls(files_1010, "S-1010", Parser1010)
 
     for name, df in parsed_1010.items():
         with st.expander(f"{name} – {len(df):,} linhas"):
-            st.dataframe(df, use_container_width=True)
+            mostrar_tabela(name, df)
+else:
+    descartar_xmls("S-1010")
 
 ###############################################################################
 # Passo 2 – S-2299 ############################################################
@@ -477,25 +885,16 @@ files_2299 = st.file_uploader(
     key="s2299",
 )
 
-parsed_2299 = {}
+parsed_2299: Dict[str, pd.DataFrame] = {}
+keys_2299: tuple = ()
 if files_2299:
-    tmp3 = {"CABECALHO_2299": [], "DEMONSTRATIVO_2299": [], "RUBRICAS_2299": []}
-    for f in files_2299:
-        event_code = detect_event_code(f.getvalue())
-        if event_code != "S-2299":
-            st.warning(f"{f.name}: evento {event_code} não suportado neste passo; arquivo ignorado.")
-            continue
-        try:
-            res = Parser2299.parse(f.getvalue(), f.name)
-            for k in tmp3:
-                tmp3[k].append(res[k])
-        except Exception as e:
-            st.error(f"Erro ao processar {f.name}: {e}")
-    parsed_2299 = {k: pd.concat(v, ignore_index=True) for k, v in tmp3.items() if v}
+    parsed_2299, keys_2299 = carregar_xmls(files_2299, "S-2299", Parser2299)
 
     for name, df in parsed_2299.items():
         with st.expander(f"{name} – {len(df):,} linhas"):
-            st.dataframe(df, use_container_width=True)
+            mostrar_tabela(name, df)
+else:
+    descartar_xmls("S-2299")
 
 ###############################################################################
 # Passo 3 – S-1200 ############################################################
@@ -507,49 +906,36 @@ files_1200 = st.file_uploader(
     "Selecione os arquivos XML do S-1200", type=["xml"], accept_multiple_files=True, key="s1200"
 )
 
-parsed_1200: Dict[str, List[pd.DataFrame]] = {}
+parsed_1200: Dict[str, pd.DataFrame] = {}
+keys_1200: tuple = ()
 if files_1200:
-    tmp2: Dict[str, List[pd.DataFrame]] = {
-        "CABECALHO_1200": [],
-        "DEMONSTRATIVO_1200": [],
-        "RUBRICAS_1200": [],
-    }
-    for f in files_1200:
-        event_code = detect_event_code(f.getvalue())
-        if event_code != "S-1200":
-            st.warning(f"{f.name}: evento {event_code} não suportado neste passo; arquivo ignorado.")
-            continue
-        try:
-            res = Parser1200.parse(f.getvalue(), f.name)
-            for k in tmp2:
-                tmp2[k].append(res[k])
-        except Exception as e:
-            st.error(f"Erro ao processar {f.name}: {e}")
-    parsed_1200 = {k: pd.concat(v, ignore_index=True) for k, v in tmp2.items() if v}
+    parsed_1200, keys_1200 = carregar_xmls(files_1200, "S-1200", Parser1200)
 
     for name, df in parsed_1200.items():
         with st.expander(f"{name} – {len(df):,} linhas"):
-            st.dataframe(df, use_container_width=True)
+            mostrar_tabela(name, df)
+else:
+    descartar_xmls("S-1200")
 
 ######################################################################
 # RUBRICAS 1200 + 2299  ➜  ENRIQUECE COM S-1010
 ######################################################################
 if parsed_1010 and parsed_1200 and parsed_2299:
     # 1) Harmoniza e empilha rubricas de 1200 + 2299
-    df_1200_rb = parsed_1200["RUBRICAS_1200"].copy()
+    df_1200_rb = parsed_1200["RUBRICAS_1200"]
     df_2299_rb = harmonizar_rubricas_2299(parsed_2299["RUBRICAS_2299"])
 
-    df_rubricas_unific = pd.concat([df_1200_rb, df_2299_rb], ignore_index=True)
+    df_rubricas_unific = empilhar_rubricas([df_1200_rb, df_2299_rb])
 
     # 2) Enriquecer com dados do S-1010
     df_joined = join_rubricas(
         df_rubricas_unific,
-        parsed_1010["RUBRICAS_1010"].copy(),
+        parsed_1010["RUBRICAS_1010"],
     )
 
     # 3) Exibe resultado
     with st.expander(f"RUBRICAS_1200_2299_ENRIQUECIDO – {len(df_joined):,} linhas", expanded=False):
-        st.dataframe(df_joined, use_container_width=True)
+        mostrar_tabela("RUBRICAS_1200_2299_ENRIQUECIDO", df_joined)
 
     # 4) Salva para download
     parsed_1200["RUBRICAS_1200_2299_ENRIQUECIDO"] = df_joined
@@ -559,37 +945,42 @@ if parsed_1010 and parsed_1200 and parsed_2299:
 ###############################################################################
 
 if parsed_1010 and parsed_2299 and parsed_1200:
-    buf_all = io.BytesIO()
-    with pd.ExcelWriter(buf_all, engine="openpyxl") as wr:
-
-        # ➤ Tabelas do S-1010
-        for name, df in parsed_1010.items():
-            df.to_excel(wr, index=False, sheet_name=name[:31])
-
-        # ➤ Tabelas do S-2299
-        for name, df in parsed_2299.items():
-            df.to_excel(wr, index=False, sheet_name=name[:31])
-
-        # ➤ Rubricas unificadas (1200 + 2299) já enriquecidas
-        if "RUBRICAS_1200_2299_ENRIQUECIDO" in parsed_1200:
-            parsed_1200["RUBRICAS_1200_2299_ENRIQUECIDO"].to_excel(
-                wr,
-                index=False,
-                sheet_name="RUBRICAS_1200_2299"  # ≤31 chars
-            )
+    sheets: List[Tuple[str, pd.DataFrame]] = []
 
-        # ➤ Demais tabelas “puras” do S-1200
-        for name, df in parsed_1200.items():
-            if name == "RUBRICAS_1200_2299_ENRIQUECIDO":
-                continue  # já foi salva acima
-            df.to_excel(wr, index=False, sheet_name=name[:31])
+    # ➤ Tabelas do S-1010
+    sheets += parsed_1010.items()
 
-    buf_all.seek(0)
+    # ➤ Tabelas do S-2299
+    sheets += parsed_2299.items()
 
-    st.download_button(
-        "📥 Baixar Consolidado (1010-2299-1200)",
-        buf_all.getvalue(),
-        "s1010_s2299_s1200.xlsx",
-    )
+    # ➤ Rubricas unificadas (1200 + 2299) já enriquecidas
+    if "RUBRICAS_1200_2299_ENRIQUECIDO" in parsed_1200:
+        sheets.append(
+            ("RUBRICAS_1200_2299", parsed_1200["RUBRICAS_1200_2299_ENRIQUECIDO"])  # ≤31 chars
+        )
+
+    # ➤ Demais tabelas “puras” do S-1200
+    sheets += [
+        (name, df)
+        for name, df in parsed_1200.items()
+        if name != "RUBRICAS_1200_2299_ENRIQUECIDO"  # já foi salva acima
+    ]
+
+    # O Excel só é gerado sob demanda e fica em cache para os mesmos uploads
+    chave = (keys_1010, keys_2299, keys_1200)
+    if st.session_state.get("xlsx_chave") != chave and st.button("⚙️ Gerar Excel consolidado"):
+        st.session_state["xlsx_chave"] = chave
+    if st.session_state.get("xlsx_chave") == chave:
+        try:
+            xlsx = gerar_excel(chave, sheets)
+        except ValueError as e:
+            st.error(f"Não foi possível gerar o Excel: {e}")
+        else:
+            st.download_button(
+                "📥 Baixar Consolidado (1010-2299-1200)",
+                xlsx,
+                "s1010_s2299_s1200.xlsx",
+                on_click="ignore",
+            )
 else:
     st.info("Envie arquivos válidos dos eventos 1010, 2299 e 1200 para liberar o consolidado.")
\ No newline at end of file